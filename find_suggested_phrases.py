@@ -11,163 +11,288 @@ Terminology:
 a 'Shortcut' is a joint 'Phrase' and 'Abbreviation'.
 """
 
+import heapq
 import os
-from typing import List, Dict, Tuple
+import re
+from typing import Iterable, Iterator, List, Dict, Optional
 from collections import Counter, namedtuple
-from nltk.util import ngrams
+from functools import partial
+from itertools import chain, groupby, repeat
+from multiprocessing import Pool
+from operator import lshift, or_
 import yaml
 from preset_abbrevs import PRESET_ABBREVS, BLACKLIST
 
+try:
+    # the libyaml emitter is much faster, but pyyaml can be built without it
+    from yaml import CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeDumper as YamlDumper
+
 
 Shortcut = namedtuple("Shortcut", ["phrase", "abbrev", "score", "count", "len"])
+# a candidate phrase, ordered so that sorting ranks by score
+ScoredPhrase = namedtuple("ScoredPhrase", ["score", "phrase", "len", "count"])
 
+MIN_PHRASE_COUNT = 4  # phrases seen fewer times than this aren't worth a shortcut
 
-def get_possible_abbrevs(phrase: str) -> List[str]:
-    """Get possible short abbreviations for a phrase, in order of preference.
+# For a corpus too big to count in memory, set this to roughly cap how many n-grams are held
+# at once (per worker). Counts then become Misra-Gries estimates, each undercounted by at most
+# (total n-grams / MAX_COUNTED_NGRAMS). It needs to be in the hundreds of thousands for the
+# estimates to stay close. None counts everything exactly.
+MAX_COUNTED_NGRAMS: Optional[int] = None
+
+GRAMMAR_FIXES = {
+    "i": "I",
+    "dont": "don't",
+    "doesnt": "doesn't",
+}
+# match whole space-separated words only, so "i" in "hi" or "it" is left alone
+GRAMMAR_FIXES_RE = re.compile(r"(?<![^ ])(?:" + "|".join(map(re.escape, GRAMMAR_FIXES)) + r")(?![^ ])")
+
+
+def iter_possible_abbrevs(phrase: str) -> Iterator[str]:
+    """Yield possible short abbreviations for a phrase, in order of preference.
+    Lazy, so callers that stop at the first usable abbrev skip building the rest.
     Input phrase must be at least 2 letters."""
     if len(phrase) < 2:
-        return [phrase]
+        yield phrase
+        return
     words = phrase.split()
-    out: List[str] = []
 
     if len(words) > 1:
-        out.append("".join([w[0] for w in words]))  # acryonym
-        out.append(words[0][0] + words[1][0])
-        out.append(words[0][:2] + words[1][0])
+        yield "".join([w[0] for w in words])  # acryonym
+        yield words[0][0] + words[1][0]
+        yield words[0][:2] + words[1][0]
 
+    # one yield per candidate, so the slices after the one that's used never get built
     phrase = phrase.replace(" ", "")
+    yield phrase[0]
+    yield phrase[0] + phrase[-1]
+    yield phrase[:2]
+    yield phrase[1]
+    yield phrase[-1]
+    yield phrase[1]
+    yield phrase[:3]
+    yield phrase[:2] + phrase[-1]
+    yield phrase[0] + phrase[-2:]
+    yield phrase[:4]
+    yield phrase[:2] + phrase[-2:]
 
-    out += [
-        phrase[0],
-        phrase[0] + phrase[-1],
-        phrase[:2],
-        phrase[1],
-        phrase[-1],
-        phrase[1],
-        phrase[:3],
-        phrase[:2] + phrase[-1],
-        phrase[0] + phrase[-2:],
-        phrase[:4],
-        phrase[:2] + phrase[-2:]
-    ]
 
-    return out
+def get_possible_abbrevs(phrase: str) -> List[str]:
+    """Get possible short abbreviations for a phrase, in order of preference.
+    Input phrase must be at least 2 letters."""
+    return list(iter_possible_abbrevs(phrase))
 
 
-def match_abbrevs_to_phrases(results: List[tuple], presets : Dict[str, str]) -> Dict[str, str]:
+def match_abbrevs_to_phrases(results: List[ScoredPhrase], presets : Dict[str, str],
+                             phrase_counts: Dict[str, int]) -> List[Shortcut]:
     """Find the best abbreviation for each phrase without overlap.
 
-    Returns a dict of phrase -> abbrev, i.e. {'because': 'bc'}.
+    Returns a list of Shortcuts, presets first, i.e. [Shortcut('because', 'bc', ...), ...].
+    Each Shortcut's score is the number of chars it saves across the corpus.
+    `results` must come from phrase_counts, which also gives the presets their counts.
 
     Highest scoring phrases get priority for most memorable shortcuts.
     """
-    # start with the presets and blacklist
-    abbrev_set = BLACKLIST
-    shortcut_dict = presets
-    for _, v in shortcut_dict.items():
-        abbrev_set.add(v)
+    # start with the presets and blacklist. copy, so the blacklist isn't grown across calls
+    abbrev_set = set(BLACKLIST)
+    abbrev_set.update(presets.values())
 
-    for row in results:
-        score, phrase = row[0], row[1]
+    shortcuts: List[Shortcut] = []
+    for score, phrase, phrase_len, count in results:
 
         # skip anything already in the presets
-        if phrase in shortcut_dict:
+        if phrase in presets:
             continue
 
-        posssible_abbrevs = get_possible_abbrevs(phrase)
-        for abbrev in posssible_abbrevs:  # ordered best to worst, so we can take the firs that works
-            if abbrev not in abbrev_set and len(abbrev) < len(phrase) - 1:  # save at least two chars
+        max_abbrev_len = phrase_len - 2  # save at least two chars
+        for abbrev in iter_possible_abbrevs(phrase):  # ordered best to worst, so we can take the first that works
+            if len(abbrev) <= max_abbrev_len and abbrev not in abbrev_set:
                 abbrev_set.add(abbrev)
-                shortcut_dict[phrase] = abbrev
+                shortcuts.append(Shortcut(phrase, abbrev, count * (phrase_len - len(abbrev)), count, phrase_len))
                 break
         else:
             print(f"warning, no abbrev for {phrase} with score {score}")
 
-    return shortcut_dict
+    preset_shortcuts = []
+    for phrase, abbrev in presets.items():
+        count = phrase_counts.get(phrase, 0)
+        preset_shortcuts.append(Shortcut(phrase, abbrev, count * (len(phrase) - len(abbrev)), count, len(phrase)))
+
+    return preset_shortcuts + shortcuts
 
 
-def load_corpus(corpus_path="data/corpus/") -> List[str]:
-    """Load all txt files under data/corpus, and return as a list of strings"""
-    all_lines = []
-    found_data = False
-    for filename in os.listdir(corpus_path):
-        if filename.endswith(".txt"):
-            found_data = True
-            with open(os.path.join(corpus_path, filename), 'r', encoding="utf8") as f:
-                all_lines.extend(f.readlines())
-    if not found_data:
+def list_corpus_files(corpus_path="data/corpus/") -> List[str]:
+    """List the paths of all txt files under data/corpus, in name order"""
+    with os.scandir(corpus_path) as entries:
+        paths = sorted(e.path for e in entries if e.is_file() and e.name.endswith(".txt"))
+    if not paths:
         print("Warning: No txt files found in data/corpus/")
-    all_lines = [line.strip() for line in all_lines]
-    return all_lines
+    return paths
+
+
+def load_corpus_file(path: str) -> Iterator[List[str]]:
+    """Yield each non-blank line of one corpus file as a list of tokens.
+    The file is read with a single read()."""
+    with open(path, 'r', encoding="utf8") as f:
+        data = f.read()
+    # split on "\n" only, like iterating the file would: text mode has already turned "\r\n" and "\r"
+    # into "\n", and splitlines() would also break lines on \v, \f, \u2028 and friends.
+    # filter(None, ...) drops the empty token lists of blank lines, all in C,
+    # so the counting loops never see them
+    yield from filter(None, map(str.split, data.split("\n")))
+
+
+def corpus_to_packed_ngrams(corpus: Iterable[List[str]], max_n: int, word_ids: Dict[str, int],
+                            capacity: Optional[int] = None) -> Counter:
+    """Convert a corpus of tokenized lines into a Counter of n-grams keyed by packed word ids
+    (see unpack_ngram), skipping n-grams with words outside word_ids. Pruned if over capacity."""
+    bits = len(word_ids).bit_length()
+    all_counts = Counter()
+    for tokens in corpus:
+        ids = list(map(word_ids.get, tokens))
+        if None in ids:
+            # count within each run of known words, so no n-gram spans a skipped word
+            runs = [list(run) for known, run in groupby(ids, bool) if known]
+        else:
+            runs = [ids]
+        for run in runs:
+            all_counts.update(run)
+            ngram_keys = run
+            for n in range(2, max_n + 1):
+                # extend each (n-1)-gram key by the id of the word that follows it.
+                # map over operator functions keeps all the packing in C
+                ngram_keys = list(map(or_, ngram_keys, map(lshift, run[n - 1:], repeat(bits * (n - 1)))))
+                all_counts.update(ngram_keys)
+        if capacity is not None and len(all_counts) > 2 * capacity:
+            all_counts = prune_counts(all_counts, capacity)
 
+    return all_counts
 
-def corpus_to_ngrams(corpus: List[str], max_n: int) -> Counter:
-    """Convert a corpus of strings into a Counter of n-grams of various lengths"""
-    all_counts = Counter()
-    for line in corpus:
-        tokenized = line.split()
-        for n in range(1, max_n + 1):
-            gram = ngrams(tokenized, n)
-            all_counts.update(Counter(gram))
 
+def prune_counts(counts: Counter, capacity: int) -> Counter:
+    """Shrink counts to at most capacity keys, Misra-Gries style: lower every count by the
+    (capacity + 1)th largest and drop what reaches zero."""
+    if len(counts) <= capacity:
+        return counts
+    threshold = heapq.nlargest(capacity + 1, counts.values())[-1]
+    return Counter({key: count - threshold for key, count in counts.items() if count > threshold})
+
+
+def pack_ngram(phrase: str, word_ids: Dict[str, int], bits: int) -> int:
+    """Turn a phrase into its corpus_to_packed_ngrams key. Every word must be in word_ids."""
+    key = 0
+    for i, word in enumerate(phrase.split()):
+        key |= word_ids[word] << (bits * i)
+    return key
+
+
+def unpack_ngram(key: int, words: List[str], bits: int) -> str:
+    """Turn a key from corpus_to_packed_ngrams back into its phrase.
+    words[i] is the word with id i, and bits is len(word_ids).bit_length()."""
+    mask = (1 << bits) - 1
+    phrase_words = []
+    while key:  # ids start at 1, so every packed word is nonzero
+        phrase_words.append(words[key & mask])
+        key >>= bits
+    return " ".join(phrase_words)
+
+
+def count_one_file(path: str, max_n: int, word_ids: Dict[str, int], capacity: Optional[int] = None) -> Counter:
+    """Count the packed n-grams of a single corpus file (see corpus_to_packed_ngrams).
+    Top level so it can run in a worker process."""
+    return corpus_to_packed_ngrams(load_corpus_file(path), max_n, word_ids, capacity)
+
+
+def count_corpus_files(paths: List[str], max_n: int, word_ids: Dict[str, int],
+                       capacity: Optional[int] = None) -> Counter:
+    """Count the packed n-grams of all the corpus files, one worker process per file.
+    Pure python counting is bound by the GIL, so it needs processes rather than threads."""
+    n_workers = min(len(paths), os.cpu_count() or 1)
+    if n_workers < 2:
+        # a pool would only add the cost of pickling each file's Counter back to this process
+        lines = (tokens for path in paths for tokens in load_corpus_file(path))
+        return corpus_to_packed_ngrams(lines, max_n, word_ids, capacity)
+
+    all_counts = Counter()
+    count_file = partial(count_one_file, max_n=max_n, word_ids=word_ids, capacity=capacity)
+    with Pool(n_workers) as pool:
+        # imap, not imap_unordered: pruned merges depend on order, so keep capped runs reproducible
+        for file_counts in pool.imap(count_file, paths):
+            all_counts.update(file_counts)
+            if capacity is not None:
+                all_counts = prune_counts(all_counts, capacity)
     return all_counts
 
 
-def get_best_phrases_to_shorten(phrase_counts: Counter, n_to_keep: int) -> List[tuple]:
-    """Get the best scoring phrases that should be shortened into abbreviations"""
-    phrase_data : List[Tuple] = []
-    for phrase_tuple, count in phrase_counts.items():
-        if count <= 3:  # don't count rare but super long phrases
+def count_frequent_ngrams(paths: List[str], max_n: int, min_count: int,
+                          capacity: Optional[int] = None, always_count: Iterable[str] = ()) -> Counter:
+    """Count the n-grams of the corpus files seen at least min_count times, plus the phrases in
+    always_count however rare. Counts words first, so n-grams with a rare word are never stored."""
+    word_counts = Counter()
+    for path in paths:
+        word_counts.update(chain.from_iterable(load_corpus_file(path)))
+    always_count = [phrase for phrase in always_count if len(phrase.split()) <= max_n]
+    vocab = {word for word, count in word_counts.items() if count >= min_count}
+    vocab.update(word for phrase in always_count for word in phrase.split() if word in word_counts)
+    words = [""] + list(vocab)
+    word_ids = {word: i for i, word in enumerate(words) if i > 0}
+    bits = len(word_ids).bit_length()
+
+    packed_counts = count_corpus_files(paths, max_n, word_ids, capacity)
+    phrase_counts = Counter({unpack_ngram(key, words, bits): count
+                             for key, count in packed_counts.items() if count >= min_count})
+    for phrase in always_count:
+        if word_ids.keys() >= set(phrase.split()):
+            phrase_counts[phrase] = packed_counts[pack_ngram(phrase, word_ids, bits)]
+    return +phrase_counts  # drop the presets that never occur
+
+
+def score_phrases(phrase_counts: Counter) -> Iterator[ScoredPhrase]:
+    """Yield a ScoredPhrase for every phrase worth shortening"""
+    for phrase, count in phrase_counts.items():
+        if count < MIN_PHRASE_COUNT:  # don't count rare but super long phrases
             continue
-        phrase = " ".join(phrase_tuple)
         phrase_len = len(phrase)
         if phrase_len < 2: # length 1 phrases can't be abbreviated
             continue
         avg_shortcut_len = 2
         score = (phrase_len - avg_shortcut_len) * count  # how many chars will be saved
-        phrase_data.append((score, phrase, phrase_len, count))
+        yield ScoredPhrase(score, phrase, phrase_len, count)
 
-    phrase_data = sorted(phrase_data, reverse=True)
-    phrase_data = phrase_data[:n_to_keep]
-    return phrase_data
+
+def get_best_phrases_to_shorten(phrase_counts: Counter, n_to_keep: int) -> List[ScoredPhrase]:
+    """Get the best scoring phrases that should be shortened into abbreviations"""
+    # same result as sorted(..., reverse=True)[:n_to_keep], without sorting every phrase
+    return heapq.nlargest(n_to_keep, score_phrases(phrase_counts))
 
 
 def fix_grammer(text: str) -> str:
     """Fix grammar in text"""
-    words = text.split(" ")
-    fixes = {
-        "i": "I",
-        "dont": "don't",
-        "doesnt": "doesn't",
-    }
-    return " ".join([fixes.get(word, word) for word in words])
+    return GRAMMAR_FIXES_RE.sub(lambda m: GRAMMAR_FIXES[m.group(0)], text)
 
 
-def save_shortcuts(shortcuts: Dict[str, str]) -> None:
+def save_shortcuts(shortcuts: Dict[str, str], path="output/suggested_shortcuts.yaml") -> None:
     """Save the shortcuts to a yaml file"""
-    with open("output/suggested_shortcuts.yaml", 'w', encoding="utf8") as f:
-        yaml.dump(shortcuts, f, default_flow_style=False)
+    # render to a string first, so the file gets one write instead of many small ones from the emitter
+    text = yaml.dump(shortcuts, Dumper=YamlDumper, default_flow_style=False)
+    with open(path, 'w', encoding="utf8") as f:
+        f.write(text)
 
 
 if __name__ == "__main__":
 
-    texts = load_corpus()
-    all_counts = corpus_to_ngrams(texts, 4)
+    all_counts = count_frequent_ngrams(list_corpus_files(), 4, MIN_PHRASE_COUNT, MAX_COUNTED_NGRAMS,
+                                       PRESET_ABBREVS)
     top_results = get_best_phrases_to_shorten(all_counts, 200)
 
-    shortcuts = match_abbrevs_to_phrases(top_results, PRESET_ABBREVS)
-
-    final_results = []
-    for phrase, abbrev in shortcuts.items():
-        key = tuple(phrase.split())
-        count = all_counts[key]
-        score = count * (len(phrase) - len(abbrev))
-        final_results.append((score, phrase, abbrev, count))
-
-    final_results = sorted(final_results)
+    shortcuts = match_abbrevs_to_phrases(top_results, PRESET_ABBREVS, all_counts)
+    shortcuts = sorted(shortcuts, key=lambda s: (s.score, s.phrase))
 
-    for score, phrase, abbrev, count in final_results:
-        print(f"{score:5}\t{phrase:20}:{abbrev}")
+    for shortcut in shortcuts:
+        print(f"{shortcut.score:5}\t{shortcut.phrase:20}:{shortcut.abbrev}")
 
-    final_shortcuts = {fix_grammer(phrase): abbrev for _, phrase, abbrev, _ in final_results}
+    final_shortcuts = {fix_grammer(shortcut.phrase): shortcut.abbrev for shortcut in shortcuts}
     save_shortcuts(final_shortcuts)
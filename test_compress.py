@@ -7,14 +7,26 @@ in order to keep parity with what's running in CI.
 import json
 from typing import Counter
 import os
+import yaml
 
 from find_suggested_phrases import (
     get_possible_abbrevs,
+    iter_possible_abbrevs,
     get_best_phrases_to_shorten,
     match_abbrevs_to_phrases,
-    corpus_to_ngrams,
+    corpus_to_packed_ngrams,
+    pack_ngram,
+    unpack_ngram,
+    count_corpus_files,
+    count_one_file,
+    count_frequent_ngrams,
     fix_grammer,
-    load_corpus
+    list_corpus_files,
+    load_corpus_file,
+    prune_counts,
+    save_shortcuts,
+    ScoredPhrase,
+    Shortcut,
 )
 from generate_autokeys import create_autokey_config_for_shortcut
 from parse_slack import extract_slack_msgs, clean_slack_msg
@@ -53,6 +65,10 @@ def test_get_abbreviations():
     out = get_possible_abbrevs("in the robots")
     assert "itr" in out
 
+    # the lazy version yields the same candidates in the same order
+    assert list(iter_possible_abbrevs("in the robots")) == get_possible_abbrevs("in the robots")
+    assert next(iter_possible_abbrevs("in the robots")) == "itr"
+
 
 def test_match_abbrevs():
     input_phrases = [
@@ -102,15 +118,28 @@ def test_match_abbrevs():
         'on the': 'ont'
      }
     presets = {"about": "ab", "and": "n", "i think": "itk"}
-    shortcuts = match_abbrevs_to_phrases(input_phrases, presets)
-    assert expected == shortcuts
+    # the counts input_phrases came from, for the presets
+    phrase_counts = Counter({"about": 300, "and": 4128, "i think": 520})
+    shortcuts = match_abbrevs_to_phrases(input_phrases, presets, phrase_counts)
+    assert expected == {s.phrase: s.abbrev for s in shortcuts}
+
+    # running again gives the same answer, since nothing is left behind in BLACKLIST
+    shortcuts = match_abbrevs_to_phrases(input_phrases, presets, phrase_counts)
+    assert expected == {s.phrase: s.abbrev for s in shortcuts}
+    assert "tr" not in BLACKLIST
+
+    # counts and lengths are carried over from the input rows
+    by_phrase = {s.phrase: s for s in shortcuts}
+    assert by_phrase['the robot'] == Shortcut('the robot', 'tr', 589 * 7, 589, 9)
+    assert by_phrase['and'] == Shortcut('and', 'n', 4128 * 2, 4128, 3)  # a preset found in the results
+    assert by_phrase['about'] == Shortcut('about', 'ab', 300 * 3, 300, 5)  # a preset that isn't
 
 
 def test_get_top_shortcuts():
     all_counts = Counter({
-        ("hello",): 10,
-        ("robots",): 3,
-        ("hello", "world"): 5,
+        "hello": 10,
+        "robots": 3,
+        "hello world": 5,
     })
     out = get_best_phrases_to_shorten(all_counts, 2)
     # score, phrase, phrase_len, count
@@ -119,40 +148,141 @@ def test_get_top_shortcuts():
         (30, "hello", 5, 10)
     ]
     assert out == expected
+    assert out[0] == ScoredPhrase(score=45, phrase="hello world", len=11, count=5)
 
 
-def test_corpus_to_n_grams():
-    corpus = [
-        "hello world",
-        "hello world goodbye world"
-    ]
-    out = corpus_to_ngrams(corpus, 2)
+def test_corpus_to_n_grams(tmp_path):
+    with open(tmp_path / "doc.txt", 'w', encoding="utf8") as f:
+        f.write("hello world\nhello world goodbye world\n")
+    out = count_frequent_ngrams(list_corpus_files(str(tmp_path)), 2, 1)
     expected = Counter({
-        ("hello",): 2,
-        ("world",): 3,
-        ("goodbye",): 1,
-        ("hello", "world"): 2,
-        ("world", "goodbye"): 1,
-        ("goodbye", "world"): 1,
+        "hello": 2,
+        "world": 3,
+        "goodbye": 1,
+        "hello world": 2,
+        "world goodbye": 1,
+        "goodbye world": 1,
     })
     assert expected == out
 
 
+def test_corpus_to_packed_ngrams():
+    corpus = [["the", "rare", "robot", "the", "robot"], ["robot"]]
+    word_ids = {"the": 1, "robot": 2}
+    words = ["", "the", "robot"]
+    bits = len(word_ids).bit_length()
+    out = corpus_to_packed_ngrams(corpus, 3, word_ids)
+    # nothing with "rare" in it, and no n-grams that span it
+    expected = Counter({
+        "the": 2,
+        "robot": 3,
+        "the robot": 1,
+        "robot the": 1,
+        "robot the robot": 1,
+    })
+    assert expected == Counter({unpack_ngram(key, words, bits): count for key, count in out.items()})
+    assert unpack_ngram(pack_ngram("robot the robot", word_ids, bits), words, bits) == "robot the robot"
+
+
+def test_count_frequent_ngrams(monkeypatch):
+    paths = list_corpus_files("test_data/test_corpus/")
+    expected = Counter({
+        "hello": 1, "world": 1, "testing": 1, "also": 1, "here": 1,
+        "hello world": 1, "also here": 1,
+    })
+    assert count_frequent_ngrams(paths, 2, 1) == expected
+    monkeypatch.setattr(os, "cpu_count", lambda: 2)  # packed keys from worker processes too
+    assert count_frequent_ngrams(paths, 2, 1) == expected
+    assert not count_frequent_ngrams(paths, 2, 2)  # every word in the test corpus is seen once
+    # presets are counted even when they're rare, and dropped if they never occur
+    assert count_frequent_ngrams(paths, 2, 2, always_count=["hello world", "nope"]) == Counter({"hello world": 1})
+
+
+def test_prune_counts():
+    counts = Counter({"the": 10, "robot": 5, "in the": 3, "hello": 1})
+    assert prune_counts(counts, 4) is counts  # already small enough
+    # everything drops by the 3rd largest count, 3
+    assert prune_counts(counts, 2) == Counter({"the": 7, "robot": 2})
+
+
+def test_count_frequent_ngrams_capacity(tmp_path, monkeypatch):
+    # a frequent phrase in every file, among a long tail of words that are each seen 4 times
+    for i in range(4):
+        with open(tmp_path / f"doc{i}.txt", 'w', encoding="utf8") as f:
+            f.write("the robot\n" * 50)
+            f.write("\n".join(f"word{j}" for j in range(200)) + "\n")
+    paths = list_corpus_files(str(tmp_path))
+    total = 4 * (50 * 3 + 200)  # n-grams seen, per the Misra-Gries bound
+    word_ids = {"the": 1, "robot": 2, **{f"word{j}": j + 3 for j in range(200)}}
+    bits = len(word_ids).bit_length()
+    the_robot = pack_ngram("the robot", word_ids, bits)
+
+    for cpu_count in [1, 4]:  # the serial path, then the pool path
+        monkeypatch.setattr(os, "cpu_count", lambda n=cpu_count: n)
+
+        packed = count_corpus_files(paths, 2, word_ids, capacity=20)
+        assert len(packed) <= 20
+        assert 200 - total / 21 <= packed[the_robot] <= 200  # never overcounted
+
+        out = count_frequent_ngrams(paths, 2, 4, capacity=20)
+        assert 200 - total / 21 <= out["the robot"] <= 200
+        assert all(count <= 4 for phrase, count in out.items() if phrase.startswith("word"))
+        assert count_frequent_ngrams(paths, 2, 4)["the robot"] == 200  # exact without a capacity
+
+
 def test_load_corpus():
-    all_lines = load_corpus("test_data/test_corpus/")
-    expected = ["hello world", "testing", "also here"]
+    paths = list_corpus_files("test_data/test_corpus/")
+    all_lines = [tokens for path in paths for tokens in load_corpus_file(path)]
+    expected = [["hello", "world"], ["testing"], ["also", "here"]]
     assert all_lines == expected
 
 
+def test_load_corpus_file_line_breaks(tmp_path):
+    path = tmp_path / "doc.txt"
+    with open(path, 'w', encoding="utf8", newline="") as f:
+        f.write("hello\u2028world\r\nsee\x0cyou\rlater\n")
+    # only real newlines end a line; the other separators are just whitespace within it
+    assert list(load_corpus_file(path)) == [["hello", "world"], ["see", "you"], ["later"]]
+
+
+def test_count_corpus_files(monkeypatch):
+    paths = list_corpus_files("test_data/test_corpus/")
+    assert [os.path.basename(p) for p in paths] == ["doc1.txt", "doc2.txt"]
+
+    word_ids = {"hello": 1, "world": 2, "testing": 3, "also": 4, "here": 5}
+    assert count_one_file(paths[1], 2, word_ids) == Counter({4: 1, 5: 1, 4 | 5 << 3: 1})
+
+    # bits per word is 3: "hello world" is 1 | 2 << 3
+    expected = Counter({1: 1, 2: 1, 1 | 2 << 3: 1, 3: 1, 4: 1, 5: 1, 4 | 5 << 3: 1})
+    assert count_corpus_files(paths, 3, word_ids) == expected
+
+    # and so does the multiprocess path, even on a single core machine
+    monkeypatch.setattr(os, "cpu_count", lambda: 2)
+    assert count_corpus_files(paths, 3, word_ids) == expected
+
+
 def test_fix_grammer():
     for word, expected in [
         ("i think", "I think"),
         ("dont", "don't"),
         ("it doesnt matter", "it doesn't matter"),
+        ("hi its dontcha", "hi its dontcha"),  # only whole words are fixed
     ]:
         assert expected == fix_grammer(word)
 
 
+def test_save_shortcuts(tmp_path):
+    shortcuts = {"because": "bc", "I think": "itk", "Best,\n\n  - Erik": "bst"}
+    path = tmp_path / "suggested_shortcuts.yaml"
+    save_shortcuts(shortcuts, path)
+
+    with open(path, 'r', encoding="utf8") as f:
+        out = f.read()
+    # same format as the default yaml.dump, so diffs against shortcuts.yaml stay clean
+    assert out == yaml.dump(shortcuts, default_flow_style=False)
+    assert yaml.safe_load(out) == shortcuts
+
+
 def test_autokey_configs():
     # TODO: mock filesystem so none of this touches disk. oh well...
     create_autokey_config_for_shortcut("test_because", "bc")